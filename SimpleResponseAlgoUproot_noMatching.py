@@ -0,0 +1,194 @@
+import sys
+import os
+import math
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numba
+import numpy as np
+import awkward as ak
+import uproot
+import boost_histogram as bh
+
+# Columnar version of SimpleResponseAlgoRDF_noMatching.py, producing the same histograms.
+# Instead of going through the xAOD EDM (one virtual call per object and per variable),
+# only the branches of the auxiliary stores holding the few primitive variables we need
+# are read in bulk with uproot, and all the quantities are computed on whole arrays at once.
+
+# --- Configuration ---
+# Use an environment variable or hardcode the path to your AOD file
+# Make sure this file exists and is accessible!
+# You can provide a single filename or a list of filenames: ["file1.root", "file2.root"] (space-separated in the environment variable)
+input_files = os.getenv("AOD_FILE_PATH", "user.cyoung.43212508.EXT0._000438.pool.root").split()
+# The standard TTree name in ATLAS xAOD files
+tree_name = "CollectionTree"
+# Output file for histograms
+output_filename = "analysis_output_uproot.root"
+# The input is read in batches of (roughly) this size: the memory used grows with it
+step_size = "100 MB"
+# Number of threads used to decompress the input and to process the batches.
+# 0 uses one thread per physical core (assuming 2 hardware threads per core).
+n_threads = int(os.getenv("SPJES_THREADS", "0")) or max(1, (os.cpu_count() or 2) // 2)
+# PDGID required for the leading particle (211: pi+)
+pdg_id = int(os.getenv("SPJES_PDGID", "211"))
+
+cluster_collection = "CaloCalTopoClusters"
+particle_collection = "TruthParticles"
+
+# The variables of the xAOD containers are stored in the branches of their auxiliary store,
+# "<collection>Aux.<variable>" (or "<collection>AuxDyn.<variable>" for dynamic variables).
+# The truth particles only store their four-momentum as (px, py, pz), pT and eta are computed from those.
+branches = {
+    "cluster_E": f"{cluster_collection}Aux.rawE",
+    "cluster_M": f"{cluster_collection}Aux.rawM",
+    "cluster_eta": f"{cluster_collection}Aux.rawEta",
+    "particle_pdgId": f"{particle_collection}Aux.pdgId",
+    "particle_px": f"{particle_collection}Aux.px",
+    "particle_py": f"{particle_collection}Aux.py",
+    "particle_pz": f"{particle_collection}Aux.pz",
+}
+
+# ATLAS stores energies/momenta in MeV, the histograms use GeV.
+MEV_TO_GEV = 1e-3
+
+
+# --- Response Kernel ---
+# pT response of the leading cluster w.r.t. the leading particle (see the RDataFrame version for details),
+# together with the pT [GeV] and eta of the leading particle.
+# Written as an explicit loop compiled with numba, so that all the operations are done in a single pass
+# over the inputs instead of NumPy creating (and going through) a temporary array for each of them.
+# The loop itself is serial: the batches are already processed in parallel by the consumer threads
+# (hence nogil), and a parallel kernel launched from each of them would oversubscribe the cores.
+@numba.njit(fastmath=True, nogil=True)
+def compute_response(E, M, eta, px, py, pz, n_clusters, response, particle_pt, particle_eta):
+    for i in range(len(E)):
+        pt = math.sqrt(px[i]*px[i] + py[i]*py[i])
+        particle_pt[i] = pt * MEV_TO_GEV
+        particle_eta[i] = math.asinh(pz[i] / pt)
+        # Dummy value if there are less than 2 clusters, as in the RDataFrame version
+        if n_clusters[i] < 2:
+            response[i] = -1.0
+            continue
+        cluster_pt = math.sqrt(E[i]*E[i] - M[i]*M[i]) / math.cosh(eta[i])
+        response[i] = cluster_pt / pt
+
+
+# --- Histograms ---
+# Same binning as the RDataFrame version.
+# Each batch fills its own set of histograms, which are then added up.
+def make_histograms():
+    return {
+        "h_nClusters": bh.Histogram(bh.axis.Regular(20, -0.5, 19.5)),
+        "h_nParticles": bh.Histogram(bh.axis.Regular(20, -0.5, 19.5)),
+        "h_PDGIDs": bh.Histogram(bh.axis.Regular(1000, 0, 1000)),
+        "h_leading_cluster_e": bh.Histogram(bh.axis.Regular(100, 0, 500)),
+        "h_inclusive_response": bh.Histogram(bh.axis.Regular(100, 0, 3)),
+        # Response vs pT and eta of the leading particle, and its mean with a finer pT/eta binning
+        "h_response": bh.Histogram(bh.axis.Regular(20, 0, 2), bh.axis.Regular(40, 0, 500), bh.axis.Regular(20, -3, 3)),
+        "p_response": bh.Histogram(bh.axis.Regular(100, 0, 500), bh.axis.Regular(60, -3, 3), storage=bh.storage.Mean()),
+    }
+
+
+# --- Batch Processing ---
+
+# Select the events of a batch and fill the histograms, returns (histograms, n_events, n_selected_events)
+def process_batch(batch):
+    histograms = make_histograms()
+    arrays = {name: batch[branch] for name, branch in branches.items()}
+
+    nClusters = ak.num(arrays["cluster_E"])
+    nParticles = ak.num(arrays["particle_pdgId"])
+
+    # Histograms before the selection (as in the RDataFrame version).
+    # Filling with NumPy rather than awkward arrays avoids a conversion inside boost-histogram.
+    histograms["h_nClusters"].fill(ak.to_numpy(nClusters))
+    histograms["h_nParticles"].fill(ak.to_numpy(nParticles))
+
+    # Filter events: require at least 1 particle and 1 cluster in the event,
+    # and make sure that the leading particle is the one we want (by default a pion, PDGID=211)
+    has_objects = (nClusters >= 1) & (nParticles >= 1)
+    pdgId_lead = arrays["particle_pdgId"][has_objects][:, 0]
+    has_pdgId = pdgId_lead == pdg_id
+
+    # Leading cluster and particle (assuming pt-sorted, common but check!) of the selected events
+    lead = {name: ak.to_numpy(arrays[name][has_objects][has_pdgId][:, 0])
+            for name in ["cluster_E", "cluster_M", "cluster_eta", "particle_px", "particle_py", "particle_pz"]}
+    nClusters_selected = ak.to_numpy(nClusters[has_objects][has_pdgId])
+
+    leading_cluster_e = lead["cluster_E"] * MEV_TO_GEV
+
+    response = np.empty_like(lead["cluster_E"])
+    lead_particle_pt = np.empty_like(response)
+    lead_particle_eta = np.empty_like(response)
+    compute_response(lead["cluster_E"], lead["cluster_M"], lead["cluster_eta"],
+                     lead["particle_px"], lead["particle_py"], lead["particle_pz"], nClusters_selected,
+                     response, lead_particle_pt, lead_particle_eta)
+
+    histograms["h_PDGIDs"].fill(ak.to_numpy(pdgId_lead[has_pdgId]))
+    histograms["h_leading_cluster_e"].fill(leading_cluster_e)
+    histograms["h_inclusive_response"].fill(response)
+    histograms["h_response"].fill(response, lead_particle_pt, lead_particle_eta)
+    # The profile averages the response, so the events with the dummy value (-1) must not enter it
+    valid = response >= 0
+    histograms["p_response"].fill(lead_particle_pt[valid], lead_particle_eta[valid], sample=response[valid])
+
+    return histograms, len(nClusters), len(response)
+
+
+# --- Event Loop ---
+# The batches are read with uproot.iterate, which decompresses the baskets in a thread pool,
+# and each batch is processed in another thread pool while the next ones are being read.
+# At most n_threads batches are kept in flight, to bound the memory used.
+
+print(f"Processing file(s): {input_files}")
+
+histograms = make_histograms()
+n_total_events = 0
+n_selected_events = 0
+
+# Add the results of a processed batch to the totals
+def collect(future):
+    global n_total_events, n_selected_events
+    batch_histograms, n_events, n_selected = future.result()
+    for name, hist in batch_histograms.items():
+        histograms[name] += hist
+    n_total_events += n_events
+    n_selected_events += n_selected
+
+try:
+    with ThreadPoolExecutor(n_threads) as consumers:
+        pending = collections.deque()
+        for batch in uproot.iterate({input_file: tree_name for input_file in input_files},
+                                    list(branches.values()),
+                                    step_size=step_size,
+                                    decompression_executor=uproot.ThreadPoolExecutor(n_threads),
+                                    library="ak"):
+            pending.append(consumers.submit(process_batch, batch))
+            if len(pending) >= n_threads:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+except Exception as e:
+    print(f"ERROR: Failed to process the input. Check file path and integrity.")
+    print(e)
+    sys.exit(1)
+
+
+# --- Save Output ---
+
+if n_total_events == 0:
+    print(f"ERROR: Input file(s) contain no events in the TTree '{tree_name}'.")
+    sys.exit(1)
+
+print(f"Saving histograms to: {output_filename}")
+with uproot.recreate(output_filename) as output_file:
+    for name, hist in histograms.items():
+        output_file[name] = hist
+print("Histograms saved.")
+
+print("\n--- Analysis Report ---")
+print(f"Total events: {n_total_events}")
+print(f"At least 1 cluster and 1 particle, leading particle has PDGID {pdg_id}: {n_selected_events} "
+      f"({100. * n_selected_events / n_total_events:.2f} %)")
+print("---------------------\n")
+
+print("Analysis finished successfully.")